@@ -1,9 +1,16 @@
 """Main NSM interface module."""
 
+from __future__ import annotations
+
 # Standard library imports
 import ctypes
 import fcntl
-import typing
+import mmap
+import os
+import threading
+import types
+import warnings
+from collections.abc import Callable, Iterable
 
 # Related third party imports
 import cbor2
@@ -12,6 +19,23 @@ from ioctl_opt import IOC, IOC_READ, IOC_WRITE
 # Project imports
 from .structs import *
 from .exceptions import IoctlError
+from .encoder import (
+    RequestWriter,
+    encode_attestation,
+    encode_describe_nsm,
+    encode_describe_pcr,
+    encode_extend_pcr,
+    encode_get_random,
+    encode_lock_pcr,
+    encode_lock_pcrs,
+)
+
+# The C accelerator is optional. Without it, the NsmMessage is packed with
+# the struct module and sent through fcntl.ioctl.
+try:
+    from ._nsm_core import transact as _transact
+except ImportError:
+    _transact = None
 
 NSM_DEV_FILE = '/dev/nsm'
 NSM_IOCTL_MAGIC = 0x0A
@@ -19,291 +43,362 @@ NSM_IOCTL_NUMBER = 0x00
 NSM_REQUEST_MAX_SIZE = 0x1000
 NSM_RESPONSE_MAX_SIZE = 0x3000
 
-def open_nsm_device() -> typing.TextIO:
-    """Open the /dev/nsm file and return the file handle."""
-    return open(NSM_DEV_FILE, 'r')
+# The start of a successful GetRandom response: a map with one item, the text
+# string 'GetRandom', another map with one item and the text string 'random'.
+# The byte string with the random bytes follows, starting with an initial byte
+# of major type 2 (_CBOR_BYTES).
+_GET_RANDOM_RESPONSE_PREFIX = b'\xa1iGetRandom\xa1frandom'
+_CBOR_BYTES = 0x40
+
+# cbor2 replaces its pure Python encoder and decoder with a C extension when
+# one is available for the platform. Without it, encoding and decoding are
+# several times slower, so warn when the pure Python version is in use.
+if not isinstance(cbor2.loads, types.BuiltinFunctionType):
+    warnings.warn(
+        'The cbor2 C extension is not available, CBOR will be decoded in pure Python.',
+        RuntimeWarning
+    )
 
-def close_nsm_device(file_handle: typing.TextIO) -> None:
-    """Close the /dev/nsm file."""
-    file_handle.close()
+# The IOWR operation for /dev/nsm. Should always result in 3223325184.
+_NSM_IOCTL_OP = IOC(
+    IOC_READ|IOC_WRITE,
+    NSM_IOCTL_MAGIC,
+    NSM_IOCTL_NUMBER,
+    NSM_MESSAGE.size
+)
+
+class NsmDevice:
+    """
+    Handle for an opened /dev/nsm device, as returned by open_nsm_device().
+
+    Besides the file descriptor, the handle owns the request buffer, the response
+    buffer and the NsmMessage used for every request on this device. They are
+    allocated once when the device is opened and reused for each call, so no
+    buffers are allocated on the request path. Requests on one NsmDevice are
+    serialized by its lock, so a handle can be shared between threads. The
+    GIL is released during the ioctl call, so threads with their own handle
+    can wait on /dev/nsm concurrently.
+    """
+
+    __slots__ = (
+        'fd',
+        'lock',
+        'request_buffer',
+        'request_address',
+        'request_writer',
+        'response_buffer',
+        'response_address',
+        'response_view',
+        'nsm_message',
+        '_describe_nsm_cache',
+    )
 
-def lock_pcr(file_handle: typing.TextIO, index: int) -> bool:
+    def __init__(self, fd: int):
+        self.fd = fd
+        # Reentrant, because functions that update the DescribeNSM cache hold
+        # the lock around _call, which takes it again.
+        self.lock = threading.RLock()
+        self.request_buffer = (NSM_REQUEST_MAX_SIZE * ctypes.c_uint8)()
+        self.request_address = ctypes.addressof(self.request_buffer)
+        self.request_writer = RequestWriter(self.request_buffer)
+        self.response_buffer = _allocate_response_buffer()
+        self.response_address = ctypes.addressof(self.response_buffer)
+        self.response_view = memoryview(self.response_buffer).cast('B')
+        self.nsm_message = bytearray(NSM_MESSAGE.size)
+        # The DescribeNSM response, cached by describe_nsm().
+        self._describe_nsm_cache = None
+
+def _allocate_response_buffer() -> ctypes.Array:
+    """
+    Allocate a response buffer of NSM_RESPONSE_MAX_SIZE bytes.
+
+    The buffer is backed by its own private anonymous memory mapping, so it is
+    page aligned and kept apart from the Python heap. The ctypes array keeps a
+    reference to the mapping, which is released together with the array. If
+    the mapping can't be created, a regular ctypes array is used instead.
+    """
+    buffer_type = NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8
+    try:
+        mapping = mmap.mmap(-1, NSM_RESPONSE_MAX_SIZE, flags=mmap.MAP_PRIVATE)
+    except OSError:
+        return buffer_type()
+    return buffer_type.from_buffer(mapping)
+
+def open_nsm_device() -> NsmDevice:
+    """Open the /dev/nsm file and return a handle for it."""
+    # Only the file descriptor is passed to ioctl, so the file is opened
+    # without the buffering and text layers of open().
+    return NsmDevice(os.open(NSM_DEV_FILE, os.O_RDONLY))
+
+def close_nsm_device(file_handle: NsmDevice) -> None:
+    """Close the /dev/nsm file."""
+    # The fd number can be reused by the next file opened in this process, so
+    # mark the handle as closed. Closing it again is a no-op, and requests on a
+    # closed handle fail on the invalid fd instead of reaching another file.
+    if file_handle.fd == -1:
+        return
+    fd = file_handle.fd
+    file_handle.fd = -1
+    os.close(fd)
+
+def lock_pcr(file_handle: NsmDevice, index: int) -> bool:
     """Lock PCR at index."""
-    nsm_key = 'LockPCR'
-    request_data = cbor2.dumps({nsm_key: {'index': index}})
-
-    # Prepare the request and response buffers. The request buffer is the
-    # size of the request data, the response buffer is sized at NSM_RESPONSE_MAX_SIZE.
-    # This code is repeated for every type of request, because moving it to a separate
-    # function creates garbage collection issues.
-    request_buffer = ctypes.create_string_buffer(request_data, len(request_data))
-    response_buffer = (NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8)()
-
-    # Prepare a new NsmMessage struct.
-    nsm_message = NsmMessage()
-    # Create new IoVecs pointing to the request and response buffer.
-    _prepare_nsm_message_iovecs(nsm_message, request_buffer, response_buffer)
-
-    # Send the message to /dev/nsm through an ioctl call.
-    # When the call is complete, the response_buffer will
-    # be filled with response data.
-    _execute_ioctl(file_handle, nsm_message)
-
-    # Take the CBOR response and translate it to a Python dict. Return the values
-    # for this request's key.
-    decoded_response = _decode_response(nsm_message)
+    with file_handle.lock:
+        decoded_response = _call(file_handle, encode_lock_pcr, index)
+        # The locked PCRs are part of the DescribeNSM response. Clear the cache
+        # after the request while holding the lock, so describe_nsm() can't
+        # cache the locked PCRs from before this request.
+        file_handle._describe_nsm_cache = None
     if isinstance(decoded_response, dict) and 'Error' in decoded_response:
         raise IoctlError(decoded_response.get('Error'))
     return True
 
-def lock_pcrs(file_handle: typing.TextIO, lock_range: int) -> bool:
+def lock_pcrs(file_handle: NsmDevice, lock_range: int) -> bool:
     """Lock PCRs in range(0, lock_range)."""
-    nsm_key = 'LockPCRs'
-    request_data = cbor2.dumps({nsm_key: {'range': lock_range}})
-
-    # Prepare the request and response buffers. The request buffer is the
-    # size of the request data, the response buffer is sized at NSM_RESPONSE_MAX_SIZE.
-    # This code is repeated for every type of request, because moving it to a separate
-    # function creates garbage collection issues.
-    request_buffer = ctypes.create_string_buffer(request_data, len(request_data))
-    response_buffer = (NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8)()
-
-    # Prepare a new NsmMessage struct.
-    nsm_message = NsmMessage()
-    # Create new IoVecs pointing to the request and response buffer.
-    _prepare_nsm_message_iovecs(nsm_message, request_buffer, response_buffer)
-
-    # Send the message to /dev/nsm through an ioctl call.
-    # When the call is complete, the response_buffer will
-    # be filled with response data.
-    _execute_ioctl(file_handle, nsm_message)
-
-    # Take the CBOR response and translate it to a Python dict. Return the values
-    # for this request's key.
-    decoded_response = _decode_response(nsm_message)
+    with file_handle.lock:
+        decoded_response = _call(file_handle, encode_lock_pcrs, lock_range)
+        # The locked PCRs are part of the DescribeNSM response. Clear the cache
+        # after the request while holding the lock, so describe_nsm() can't
+        # cache the locked PCRs from before this request.
+        file_handle._describe_nsm_cache = None
     if isinstance(decoded_response, dict) and 'Error' in decoded_response:
         raise IoctlError(decoded_response.get('Error'))
     return True
 
-def describe_pcr(file_handle: typing.TextIO, index: int) -> dict:
+def describe_pcr(file_handle: NsmDevice, index: int) -> dict:
     """Request PCR description from /dev/nsm."""
-    nsm_key = 'DescribePCR'
-    request_data = cbor2.dumps({nsm_key: {'index': index}})
-
-    # Prepare the request and response buffers. The request buffer is the
-    # size of the request data, the response buffer is sized at NSM_RESPONSE_MAX_SIZE.
-    # This code is repeated for every type of request, because moving it to a separate
-    # function creates garbage collection issues.
-    request_buffer = ctypes.create_string_buffer(request_data, len(request_data))
-    response_buffer = (NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8)()
-
-    # Prepare a new NsmMessage struct.
-    nsm_message = NsmMessage()
-    # Create new IoVecs pointing to the request and response buffer.
-    _prepare_nsm_message_iovecs(nsm_message, request_buffer, response_buffer)
-
-    # Send the message to /dev/nsm through an ioctl call.
-    # When the call is complete, the response_buffer will
-    # be filled with response data.
-    _execute_ioctl(file_handle, nsm_message)
-
-    # Take the CBOR response and translate it to a Python dict. Return the values
-    # for this request's key.
-    decoded_response = _decode_response(nsm_message)
-    if nsm_key not in decoded_response:
-        raise IoctlError(decoded_response.get('Error'))
-    return decoded_response.get(nsm_key)
+    decoded_response = _call(file_handle, encode_describe_pcr, index)
+    return _extract(decoded_response, 'DescribePCR')
+
+def describe_pcrs(file_handle: NsmDevice, indices: Iterable[int]) -> list[dict]:
+    """Request the descriptions of the PCRs at the given indices from /dev/nsm."""
+    # /dev/nsm handles a single request per ioctl call, so the requests are
+    # sent one by one. All of them reuse the buffers of the device.
+    return [describe_pcr(file_handle, index) for index in indices]
 
 def get_attestation_doc(
-    file_handle: typing.TextIO,
+    file_handle: NsmDevice,
     user_data: bytes = None,
     nonce: bytes = None,
     public_key: bytes = None
 ) -> dict:
     """Request Attestation document from /dev/nsm."""
-    nsm_key = 'Attestation'
-    request_data = cbor2.dumps({nsm_key: {
-        'user_data': user_data,
-        'nonce': nonce,
-        'public_key': public_key,
-    }})
-
-    # Prepare the request and response buffers. The request buffer is the
-    # size of the request data, the response buffer is sized at NSM_RESPONSE_MAX_SIZE.
-    # This code is repeated for every type of request, because moving it to a separate
-    # function creates garbage collection issues.
-    request_buffer = ctypes.create_string_buffer(request_data, len(request_data))
-    response_buffer = (NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8)()
-
-    # Prepare a new NsmMessage struct.
-    nsm_message = NsmMessage()
-    # Create new IoVecs pointing to the request and response buffer.
-    _prepare_nsm_message_iovecs(nsm_message, request_buffer, response_buffer)
-
-    # Send the message to /dev/nsm through an ioctl call.
-    # When the call is complete, the response_buffer will
-    # be filled with response data.
-    _execute_ioctl(file_handle, nsm_message)
-
-    # Take the CBOR response and translate it to a Python dict. Return the values
-    # for this request's key.
-    decoded_response = _decode_response(nsm_message)
-    if nsm_key not in decoded_response:
-        raise IoctlError(decoded_response.get('Error'))
-    return decoded_response.get(nsm_key)
+    decoded_response = _call(
+        file_handle,
+        encode_attestation,
+        user_data,
+        nonce,
+        public_key
+    )
+    return _extract(decoded_response, 'Attestation')
 
-def extend_pcr(file_handle: typing.TextIO, index: int, data: bytes) -> dict:
+def extend_pcr(file_handle: NsmDevice, index: int, data: bytes) -> dict:
     """Extend the PCR at the given index."""
-    nsm_key = 'ExtendPCR'
-    request_data = cbor2.dumps({nsm_key: {'index': index, 'data': data}})
-
-    # Prepare the request and response buffers. The request buffer is the
-    # size of the request data, the response buffer is sized at NSM_RESPONSE_MAX_SIZE.
-    # This code is repeated for every type of request, because moving it to a separate
-    # function creates garbage collection issues.
-    request_buffer = ctypes.create_string_buffer(request_data, len(request_data))
-    response_buffer = (NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8)()
-
-    # Prepare a new NsmMessage struct.
-    nsm_message = NsmMessage()
-    # Create new IoVecs pointing to the request and response buffer.
-    _prepare_nsm_message_iovecs(nsm_message, request_buffer, response_buffer)
-
-    # Send the message to /dev/nsm through an ioctl call.
-    # When the call is complete, the response_buffer will
-    # be filled with response data.
-    _execute_ioctl(file_handle, nsm_message)
-
-    # Take the CBOR response and translate it to a Python dict. Return the values
-    # for this request's key.
-    decoded_response = _decode_response(nsm_message)
-    if nsm_key not in decoded_response:
-        raise IoctlError(decoded_response.get('Error'))
-    return decoded_response.get(nsm_key)
-
-def describe_nsm(file_handle: typing.TextIO) -> dict:
-    """Request NSM description from /dev/nsm."""
-    nsm_key = 'DescribeNSM'
-    request_data = cbor2.dumps(nsm_key)
-
-    # Prepare the request and response buffers. The request buffer is the
-    # size of the request data, the response buffer is sized at NSM_RESPONSE_MAX_SIZE.
-    # This code is repeated for every type of request, because moving it to a separate
-    # function creates garbage collection issues.
-    request_buffer = ctypes.create_string_buffer(request_data, len(request_data))
-    response_buffer = (NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8)()
-
-    # Prepare a new NsmMessage struct.
-    nsm_message = NsmMessage()
-    # Create new IoVecs pointing to the request and response buffer.
-    _prepare_nsm_message_iovecs(nsm_message, request_buffer, response_buffer)
-
-    # Send the message to /dev/nsm through an ioctl call.
-    # When the call is complete, the response_buffer will
-    # be filled with response data.
-    _execute_ioctl(file_handle, nsm_message)
-
-    # Take the CBOR response and translate it to a Python dict. Return the values
-    # for this request's key.
-    decoded_response = _decode_response(nsm_message)
-    if nsm_key not in decoded_response:
-        raise IoctlError(decoded_response.get('Error'))
-    return decoded_response.get(nsm_key)
-
-def get_random(file_handle: typing.TextIO, length: int = 32) -> bytes:
+    decoded_response = _call(file_handle, encode_extend_pcr, index, data)
+    return _extract(decoded_response, 'ExtendPCR')
+
+def extend_pcrs(
+    file_handle: NsmDevice,
+    updates: Iterable[tuple[int, bytes]]
+) -> list[dict]:
+    """Extend the PCRs for a sequence of (index, data) pairs."""
+    # /dev/nsm handles a single request per ioctl call, so the requests are
+    # sent one by one. All of them reuse the buffers of the device.
+    return [extend_pcr(file_handle, index, data) for index, data in updates]
+
+def describe_nsm(file_handle: NsmDevice) -> dict:
+    """
+    Request NSM description from /dev/nsm.
+
+    The description does not change while the device is open, except for the
+    locked PCRs. The response is therefore cached on the device and only
+    requested again after lock_pcr() or lock_pcrs() was called on this device.
+    The cached dict is returned as is, so it should not be modified.
+    """
+    # Hold the device lock while filling the cache, so a concurrent lock_pcr()
+    # or lock_pcrs() can't clear it between the request and storing the result.
+    with file_handle.lock:
+        if file_handle._describe_nsm_cache is None:
+            decoded_response = _call(file_handle, encode_describe_nsm)
+            file_handle._describe_nsm_cache = _extract(decoded_response, 'DescribeNSM')
+        return file_handle._describe_nsm_cache
+
+def get_random(file_handle: NsmDevice, length: int = 32) -> bytes:
     """Request random bytes from /dev/nsm."""
     if length < 1 or length > 256:
         raise ValueError('GetRandom supports length between 1 and 256 inclusive.')
 
-    nsm_key = 'GetRandom'
-    request_data = cbor2.dumps(nsm_key)
-
-    # Prepare the request and response buffers. The request buffer is the
-    # size of the request data, the response buffer is sized at NSM_RESPONSE_MAX_SIZE.
-    # This code is repeated for every type of request, because moving it to a separate
-    # function creates garbage collection issues.
-    request_buffer = ctypes.create_string_buffer(request_data, len(request_data))
-    response_buffer = (NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8)()
-
-    # Prepare a new NsmMessage struct.
-    nsm_message = NsmMessage()
-    # Create new IoVecs pointing to the request and response buffer.
-    _prepare_nsm_message_iovecs(nsm_message, request_buffer, response_buffer)
-
-    # Send the message to /dev/nsm through an ioctl call.
-    # When the call is complete, the response_buffer will
-    # be filled with response data.
-    _execute_ioctl(file_handle, nsm_message)
-
-    # Read the binary reponse from NSM, fetch the bytes stored under the key 'random'
-    # and return them to the user.
-    decoded_response = _decode_response(nsm_message)
-    random_bytes = decoded_response.get(nsm_key).get('random')
-    if nsm_key not in decoded_response:
-        raise IoctlError(decoded_response.get('Error'))
+    # GetRandom has no length parameter, /dev/nsm always returns a full block
+    # of random bytes. Only copy a slice if fewer bytes were requested.
+    random_bytes = _get_random_once(file_handle)
+    if len(random_bytes) == length:
+        return random_bytes
     return random_bytes[:length]
 
-def _decode_response(nsm_message: NsmMessage) -> dict:
-    """Read the binary reponse from NSM and return it as a Python dict."""
-    # Create a buffer with a size as defined in the IoVec.iov_len field.
-    cbor_data = bytearray(nsm_message.response.iov_len)
-
-    # Create a pointer to this buffer.
-    cbor_data_pointer = (ctypes.c_char * nsm_message.response.iov_len).from_buffer(cbor_data)
-
-    # Copy the data referenced to by the IoVec into this buffer.
-    ctypes.memmove(
-        cbor_data_pointer,
-        nsm_message.response.iov_base,
-        nsm_message.response.iov_len
-    )
-
-    # Decode the CBOR and return it.
-    return cbor2.loads(cbor_data)
-
-def _execute_ioctl(file_handle: typing.TextIO, nsm_message: NsmMessage) -> None:
-    """Send an NsmMessage to /dev/nsm trough ioctl."""
-    # Calculate the IOWR operation. Should always result in 3223325184.
-    operation = IOC(
-        IOC_READ|IOC_WRITE,
-        NSM_IOCTL_MAGIC,
-        NSM_IOCTL_NUMBER,
-        ctypes.sizeof(NsmMessage)
-    )
-    # Execute the ioctl call.
-    fcntl.ioctl(file_handle, operation, nsm_message)
-
-def _prepare_nsm_message_iovecs(
-    nsm_message: NsmMessage,
-    request_buffer: bytes,
-    response_buffer: bytes,
-) -> None:
-    """Generate the request and response IoVecs for an NsmMessage."""
-    if len(request_buffer) > NSM_REQUEST_MAX_SIZE:
-        raise ValueError('Request too large.')
-
-    # Create a pointer to the request buffer.
-    request_buffer_pointer = ctypes.cast(
-        ctypes.byref(request_buffer),
-        ctypes.c_void_p
+def get_random_stream(file_handle: NsmDevice, total_length: int) -> bytearray:
+    """
+    Request any number of random bytes from /dev/nsm.
+
+    Every GetRandom request returns a block of random bytes, so as many requests
+    are sent as needed to fill a buffer of total_length bytes. The blocks are
+    copied straight into that buffer, which is returned as a bytearray.
+    """
+    if total_length < 0:
+        raise ValueError('total_length must not be negative.')
+
+    random_bytes = bytearray(total_length)
+    random_bytes_view = memoryview(random_bytes)
+    offset = 0
+
+    def copy_random_bytes(response_view: memoryview, response_length: int) -> int:
+        """Copy the random bytes of a response to the output, return how many were copied."""
+        # This runs as the decoder of _call, while the device lock is held, so
+        # the random bytes are copied before another request can reuse the
+        # response buffer.
+        span = _locate_random_bytes(response_view, response_length)
+        if span is None:
+            block = memoryview(_decode_get_random_fallback(response_view, response_length))
+            start, end = 0, len(block)
+        else:
+            block = response_view
+            start, end = span
+        length = min(end - start, total_length - offset)
+        random_bytes_view[offset:offset + length] = block[start:start + length]
+        return length
+
+    while offset < total_length:
+        length = _call(file_handle, encode_get_random, decode_response=copy_random_bytes)
+        if not length:
+            raise IoctlError('GetRandom returned no random bytes.')
+        offset += length
+    return random_bytes
+
+def _get_random_once(file_handle: NsmDevice) -> bytes:
+    """Send a single GetRandom request and return all random bytes in the response."""
+    return _call(
+        file_handle,
+        encode_get_random,
+        decode_response=_decode_get_random_response
     )
 
-    # Create a pointer to the response buffer.
-    response_buffer_pointer = ctypes.cast(
-        ctypes.byref(response_buffer),
-        ctypes.c_void_p
-    )
-
-    # Create a new IoVec pointing to the request buffer. Assign the
-    # IoVec to the request field of the NsmMessage.
-    nsm_message.request = IoVec(
-        request_buffer_pointer,
-        len(request_buffer)
-    )
+def _extract(decoded_response: dict, nsm_key: str) -> dict:
+    """Return the value for the request's key, or raise the error returned by NSM."""
+    value = decoded_response.get(nsm_key)
+    if value is None:
+        raise IoctlError(decoded_response.get('Error'))
+    return value
 
-    # Create a new IoVec pointing to the response buffer. Assign the
-    # IoVec to the response field of the NsmMessage.
-    nsm_message.response = IoVec(
-        response_buffer_pointer,
-        len(response_buffer)
-    )
+def _decode_response(response_view: memoryview, response_length: int) -> dict:
+    """Read the binary reponse from NSM and return it as a Python dict."""
+    # The response is stored at the start of the response buffer, so decode
+    # it straight from a view on that part of the buffer.
+    return cbor2.loads(response_view[:response_length])
+
+def _locate_random_bytes(response_view: memoryview, response_length: int) -> tuple[int, int] | None:
+    """
+    Find the random bytes in a GetRandom response without decoding all of it.
+
+    A successful response always starts with the same bytes, followed by the
+    header of the byte string holding the random bytes. Returns the start and
+    end of the random bytes in the response buffer, or None if the response
+    has a different shape, for example because NSM returned an error.
+    """
+    start = len(_GET_RANDOM_RESPONSE_PREFIX)
+    if response_view[:start] == _GET_RANDOM_RESPONSE_PREFIX:
+        # Read the length of the byte string from its header. The low five
+        # bits of the initial byte hold either the length itself, or how many
+        # of the following bytes hold the length.
+        additional_info = response_view[start] - _CBOR_BYTES
+        start += 1
+        if 0 <= additional_info < 24:
+            length = additional_info
+        elif 24 <= additional_info <= 26:
+            length_size = 1 << (additional_info - 24)
+            length = int.from_bytes(response_view[start:start + length_size], 'big')
+            start += length_size
+        else:
+            length = None
+
+        # The byte string has to end exactly where the response ends.
+        if length is not None and start + length == response_length:
+            return start, response_length
+    return None
+
+def _decode_get_random_fallback(response_view: memoryview, response_length: int) -> bytes:
+    """Decode a GetRandom response with cbor2 and return the random bytes."""
+    decoded_response = _decode_response(response_view, response_length)
+    return _extract(decoded_response, 'GetRandom')['random']
+
+def _decode_get_random_response(response_view: memoryview, response_length: int) -> bytes:
+    """
+    Read the random bytes from a GetRandom response.
+
+    Responses of the expected shape are read straight from the response buffer,
+    all others are decoded with cbor2.
+    """
+    span = _locate_random_bytes(response_view, response_length)
+    if span is None:
+        return _decode_get_random_fallback(response_view, response_length)
+    start, end = span
+    return bytes(response_view[start:end])
+
+def _call(
+    file_handle: NsmDevice,
+    encode: Callable,
+    *args,
+    transact=_transact,
+    pack_nsm_message=NSM_MESSAGE.pack_into,
+    unpack_nsm_message=NSM_MESSAGE.unpack_from,
+    ioctl=fcntl.ioctl,
+    decode_response=_decode_response,
+):
+    """
+    Send a request to /dev/nsm and return the decoded response.
+
+    The request is encoded by calling encode with the request writer of the
+    device and args. The response is decoded by decode_response, which callers
+    may replace to read the response buffer directly. The other trailing
+    keyword arguments bind the helpers as local variables and should not be
+    passed by callers.
+    """
+    # The buffers of the device are shared between calls, so only one request
+    # at a time may use them. fcntl.ioctl releases the GIL while waiting for
+    # /dev/nsm, so requests on other devices and other threads keep running.
+    with file_handle.lock:
+        # Encode the request straight into the request buffer of the device.
+        request_writer = file_handle.request_writer
+        request_writer.position = 0
+        encode(request_writer, *args)
+
+        if transact is not None:
+            # Let the C accelerator build the NsmMessage and send it to
+            # /dev/nsm. It returns the length of the response.
+            response_length = transact(
+                file_handle.fd,
+                file_handle.request_buffer,
+                request_writer.position,
+                file_handle.response_buffer
+            )
+        else:
+            # Point the request IoVec at the request in the request buffer and
+            # the response IoVec at the full response buffer. The response
+            # length is reset on every call, because /dev/nsm overwrites it with
+            # the length of the response.
+            nsm_message = file_handle.nsm_message
+            pack_nsm_message(
+                nsm_message,
+                0,
+                file_handle.request_address,
+                request_writer.position,
+                file_handle.response_address,
+                NSM_RESPONSE_MAX_SIZE
+            )
+
+            # Send the message to /dev/nsm through an ioctl call.
+            # When the call is complete, the response buffer will
+            # be filled with response data.
+            ioctl(file_handle.fd, _NSM_IOCTL_OP, nsm_message)
+            response_length = unpack_nsm_message(nsm_message)[3]
+
+        # Take the CBOR response and translate it to a Python object.
+        return decode_response(file_handle.response_view, response_length)
@@ -0,0 +1,93 @@
+/*
+ * Optional C accelerator for the AWS NSM interface.
+ *
+ * Sends a request that has already been encoded into a request buffer to
+ * /dev/nsm and lets /dev/nsm write its response into a response buffer. This
+ * replaces packing the NsmMessage into a bytearray with the struct module and
+ * calling fcntl.ioctl. The package falls back to that pure Python path when
+ * this module is not built.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#include <errno.h>
+#include <sys/ioctl.h>
+#include <sys/uio.h>
+
+#define NSM_IOCTL_MAGIC 0x0A
+#define NSM_IOCTL_NUMBER 0x00
+
+struct nsm_message {
+    struct iovec request;
+    struct iovec response;
+};
+
+#define NSM_IOCTL_REQUEST _IOWR(NSM_IOCTL_MAGIC, NSM_IOCTL_NUMBER, struct nsm_message)
+
+PyDoc_STRVAR(transact_doc,
+"transact(fd, request_buffer, request_length, response_buffer) -> int\n"
+"\n"
+"Send the first request_length bytes of request_buffer to /dev/nsm and\n"
+"return the length of the response written to response_buffer.");
+
+static PyObject *
+nsm_core_transact(PyObject *self, PyObject *args)
+{
+    int fd;
+    Py_buffer request;
+    Py_ssize_t request_length;
+    Py_buffer response;
+    struct nsm_message message;
+    int result;
+
+    if (!PyArg_ParseTuple(args, "iy*nw*:transact",
+                          &fd, &request, &request_length, &response)) {
+        return NULL;
+    }
+
+    if (request_length < 0 || request_length > request.len) {
+        PyBuffer_Release(&request);
+        PyBuffer_Release(&response);
+        PyErr_SetString(PyExc_ValueError, "Request too large.");
+        return NULL;
+    }
+
+    message.request.iov_base = request.buf;
+    message.request.iov_len = (size_t)request_length;
+    message.response.iov_base = response.buf;
+    message.response.iov_len = (size_t)response.len;
+
+    /* The buffers stay exported while the GIL is released, so they can't be
+     * resized or freed by other threads during the call. */
+    Py_BEGIN_ALLOW_THREADS
+    result = ioctl(fd, NSM_IOCTL_REQUEST, &message);
+    Py_END_ALLOW_THREADS
+
+    PyBuffer_Release(&request);
+    PyBuffer_Release(&response);
+
+    if (result < 0) {
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+    return PyLong_FromSize_t(message.response.iov_len);
+}
+
+static PyMethodDef nsm_core_methods[] = {
+    {"transact", nsm_core_transact, METH_VARARGS, transact_doc},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef nsm_core_module = {
+    PyModuleDef_HEAD_INIT,
+    "_nsm_core",
+    "Optional C accelerator for the AWS NSM interface.",
+    -1,
+    nsm_core_methods
+};
+
+PyMODINIT_FUNC
+PyInit__nsm_core(void)
+{
+    return PyModule_Create(&nsm_core_module);
+}
@@ -0,0 +1,153 @@
+"""
+CBOR encoders for the requests sent to /dev/nsm.
+
+Every request has a small, fixed shape: a map with a single request key, which
+holds a map with a few known fields. Instead of passing the request through the
+generic cbor2 encoder, the constant parts are stored as pre-encoded bytes and
+only the variable fields are encoded. Values outside of the expected types fall
+back to cbor2, so the output is always identical to cbor2.dumps().
+
+The encoders write the request straight into the request buffer of the device
+through a RequestWriter, so byte string fields are copied only once.
+"""
+
+# Related third party imports
+import cbor2
+
+# CBOR major types, shifted into the high bits of the initial byte.
+_MAJOR_TYPE_UINT = 0x00
+_MAJOR_TYPE_BYTES = 0x40
+
+# The CBOR encoding of null, used for optional fields which are not set.
+_NULL = b'\xf6'
+
+# Requests without payload are sent as the bare key, a text string. They never
+# change, so they are stored fully encoded.
+_DESCRIBE_NSM_REQUEST = b'kDescribeNSM'
+_GET_RANDOM_REQUEST = b'iGetRandom'
+
+# Pre-encoded prefixes of each request, up to the first variable field.
+# For example, 0xa1 is a map with one item and 'gLockPCR' is the text string
+# 'LockPCR' preceded by its header (0x60 | len('LockPCR')).
+_LOCK_PCR_PREFIX = b'\xa1gLockPCR\xa1eindex'
+_LOCK_PCRS_PREFIX = b'\xa1hLockPCRs\xa1erange'
+_DESCRIBE_PCR_PREFIX = b'\xa1kDescribePCR\xa1eindex'
+_EXTEND_PCR_PREFIX = b'\xa1iExtendPCR\xa2eindex'
+_EXTEND_PCR_DATA_KEY = b'ddata'
+_ATTESTATION_PREFIX = b'\xa1kAttestation\xa3'
+_ATTESTATION_USER_DATA_KEY = b'iuser_data'
+_ATTESTATION_NONCE_KEY = b'enonce'
+_ATTESTATION_PUBLIC_KEY_KEY = b'jpublic_key'
+
+class RequestWriter:
+    """
+    Writable file-like object on top of a fixed size request buffer.
+
+    The position is the length of the request written so far, it has to be
+    reset to 0 before encoding a new request. Writing past the end of the
+    buffer raises a ValueError.
+    """
+
+    __slots__ = ('view', 'position')
+
+    def __init__(self, request_buffer):
+        self.view = memoryview(request_buffer).cast('B')
+        self.position = 0
+
+    def writable(self) -> bool:
+        """Report the writer as writable, which cbor2 requires for dump()."""
+        return True
+
+    def write(self, data: bytes) -> int:
+        """Copy data into the request buffer at the current position."""
+        start = self.position
+        end = start + len(data)
+        if end > len(self.view):
+            raise ValueError('Request too large.')
+        self.view[start:end] = data
+        self.position = end
+        return len(data)
+
+def _encode_head(major_type: int, value: int) -> bytes:
+    """Encode the initial byte and argument of a CBOR data item."""
+    if value < 24:
+        return bytes((major_type | value,))
+    if value < 0x100:
+        return bytes((major_type | 24, value))
+    if value < 0x10000:
+        return bytes((major_type | 25,)) + value.to_bytes(2, 'big')
+    if value < 0x100000000:
+        return bytes((major_type | 26,)) + value.to_bytes(4, 'big')
+    return bytes((major_type | 27,)) + value.to_bytes(8, 'big')
+
+# Encoded unsigned integers for every possible PCR index and range.
+_SMALL_UINTS = tuple(_encode_head(_MAJOR_TYPE_UINT, value) for value in range(0x100))
+
+def _is_small_uint(value: int) -> bool:
+    """Return whether the value can be taken from _SMALL_UINTS."""
+    # bool is a subclass of int, but is encoded differently by CBOR.
+    return type(value) is int and 0 <= value < 0x100
+
+def _write_bytes_field(writer: RequestWriter, key: bytes, value: bytes) -> None:
+    """Write an encoded map key followed by a byte string, or null if the value is None."""
+    if value is None:
+        writer.write(key + _NULL)
+    else:
+        writer.write(key + _encode_head(_MAJOR_TYPE_BYTES, len(value)))
+        writer.write(value)
+
+def encode_describe_nsm(writer: RequestWriter) -> None:
+    """Encode a DescribeNSM request."""
+    writer.write(_DESCRIBE_NSM_REQUEST)
+
+def encode_get_random(writer: RequestWriter) -> None:
+    """Encode a GetRandom request."""
+    writer.write(_GET_RANDOM_REQUEST)
+
+def encode_lock_pcr(writer: RequestWriter, index: int) -> None:
+    """Encode a LockPCR request."""
+    if _is_small_uint(index):
+        writer.write(_LOCK_PCR_PREFIX + _SMALL_UINTS[index])
+    else:
+        cbor2.dump({'LockPCR': {'index': index}}, writer)
+
+def encode_lock_pcrs(writer: RequestWriter, lock_range: int) -> None:
+    """Encode a LockPCRs request."""
+    if _is_small_uint(lock_range):
+        writer.write(_LOCK_PCRS_PREFIX + _SMALL_UINTS[lock_range])
+    else:
+        cbor2.dump({'LockPCRs': {'range': lock_range}}, writer)
+
+def encode_describe_pcr(writer: RequestWriter, index: int) -> None:
+    """Encode a DescribePCR request."""
+    if _is_small_uint(index):
+        writer.write(_DESCRIBE_PCR_PREFIX + _SMALL_UINTS[index])
+    else:
+        cbor2.dump({'DescribePCR': {'index': index}}, writer)
+
+def encode_extend_pcr(writer: RequestWriter, index: int, data: bytes) -> None:
+    """Encode an ExtendPCR request."""
+    if _is_small_uint(index) and type(data) is bytes:
+        writer.write(_EXTEND_PCR_PREFIX + _SMALL_UINTS[index])
+        _write_bytes_field(writer, _EXTEND_PCR_DATA_KEY, data)
+    else:
+        cbor2.dump({'ExtendPCR': {'index': index, 'data': data}}, writer)
+
+def encode_attestation(
+    writer: RequestWriter,
+    user_data: bytes,
+    nonce: bytes,
+    public_key: bytes
+) -> None:
+    """Encode an Attestation request."""
+    if all(value is None or type(value) is bytes for value in (user_data, nonce, public_key)):
+        writer.write(_ATTESTATION_PREFIX)
+        _write_bytes_field(writer, _ATTESTATION_USER_DATA_KEY, user_data)
+        _write_bytes_field(writer, _ATTESTATION_NONCE_KEY, nonce)
+        _write_bytes_field(writer, _ATTESTATION_PUBLIC_KEY_KEY, public_key)
+    else:
+        cbor2.dump({'Attestation': {
+            'user_data': user_data,
+            'nonce': nonce,
+            'public_key': public_key,
+        }}, writer)
@@ -14,12 +14,22 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/donkersgoed/aws-nsm-interface",
     packages=setuptools.find_packages(),
+    ext_modules=[
+        # Optional C accelerator for sending requests to /dev/nsm. If it can't
+        # be built, the package packs the NsmMessage with struct and sends it
+        # through fcntl.ioctl.
+        setuptools.Extension(
+            'aws_nsm_interface._nsm_core',
+            sources=['aws_nsm_interface/_nsm_core.c'],
+            optional=True,
+        ),
+    ],
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     install_requires=[
         'cbor2>=5.2.0',
         'ioctl-opt>=1.2.2'
@@ -0,0 +1,153 @@
+"""Tests for the specialized CBOR request encoders and GetRandom response parser."""
+
+# Standard library imports
+import ctypes
+import unittest
+
+# Related third party imports
+import cbor2
+
+# Project imports
+import aws_nsm_interface
+from aws_nsm_interface import encoder
+
+UINTS = [0, 1, 23, 24, 31, 255, 256, 65535, 65536, 2**32 - 1, 2**32, 2**64 - 1]
+NON_UINTS = [-1, -300, True, False, None, 1.5]
+BYTE_STRINGS = [b'', b'a', b'a' * 23, b'a' * 24, b'b' * 255, b'b' * 256, b'c' * 1000]
+OPTIONAL_FIELDS = [None, b'', b'n' * 24, b'k' * 300, bytearray(b'ba'), 'text']
+
+def _encode(encode, *args) -> bytes:
+    """Run an encoder against a fresh request buffer and return what it wrote."""
+    request_buffer = (aws_nsm_interface.NSM_REQUEST_MAX_SIZE * ctypes.c_uint8)()
+    writer = encoder.RequestWriter(request_buffer)
+    encode(writer, *args)
+    return bytes(writer.view[:writer.position])
+
+class TestEncoder(unittest.TestCase):
+    """The encoders must produce exactly the output of cbor2.dumps()."""
+
+    def test_constant_requests(self):
+        self.assertEqual(_encode(encoder.encode_describe_nsm), cbor2.dumps('DescribeNSM'))
+        self.assertEqual(_encode(encoder.encode_get_random), cbor2.dumps('GetRandom'))
+
+    def test_index_and_range_requests(self):
+        cases = [
+            (encoder.encode_lock_pcr, 'LockPCR', 'index'),
+            (encoder.encode_lock_pcrs, 'LockPCRs', 'range'),
+            (encoder.encode_describe_pcr, 'DescribePCR', 'index'),
+        ]
+        for encode, nsm_key, field in cases:
+            for value in UINTS + NON_UINTS:
+                with self.subTest(nsm_key=nsm_key, value=value):
+                    self.assertEqual(
+                        _encode(encode, value),
+                        cbor2.dumps({nsm_key: {field: value}})
+                    )
+
+    def test_extend_pcr(self):
+        for index in UINTS + NON_UINTS:
+            for data in BYTE_STRINGS + [bytearray(b'ab')]:
+                with self.subTest(index=index, data_length=len(data)):
+                    self.assertEqual(
+                        _encode(encoder.encode_extend_pcr, index, data),
+                        cbor2.dumps({'ExtendPCR': {'index': index, 'data': data}})
+                    )
+
+    def test_attestation(self):
+        for user_data in OPTIONAL_FIELDS:
+            for nonce in OPTIONAL_FIELDS:
+                for public_key in OPTIONAL_FIELDS:
+                    with self.subTest(user_data=user_data, nonce=nonce, public_key=public_key):
+                        self.assertEqual(
+                            _encode(encoder.encode_attestation, user_data, nonce, public_key),
+                            cbor2.dumps({'Attestation': {
+                                'user_data': user_data,
+                                'nonce': nonce,
+                                'public_key': public_key,
+                            }})
+                        )
+
+    def test_request_size_limit(self):
+        # The encoded size of an ExtendPCR request without its data, for data
+        # with a 3-byte length header.
+        overhead = len(cbor2.dumps({'ExtendPCR': {'index': 0, 'data': b'x' * 1000}})) - 1000
+        max_data = b'x' * (aws_nsm_interface.NSM_REQUEST_MAX_SIZE - overhead)
+        self.assertEqual(
+            len(_encode(encoder.encode_extend_pcr, 0, max_data)),
+            aws_nsm_interface.NSM_REQUEST_MAX_SIZE
+        )
+        with self.assertRaisesRegex(ValueError, 'Request too large.'):
+            _encode(encoder.encode_extend_pcr, 0, max_data + b'x')
+        with self.assertRaisesRegex(ValueError, 'Request too large.'):
+            _encode(encoder.encode_extend_pcr, 0, bytearray(max_data + b'x'))
+
+class TestGetRandomResponse(unittest.TestCase):
+    """The GetRandom fast path must agree with decoding the response with cbor2."""
+
+    def setUp(self):
+        self.response_buffer = (aws_nsm_interface.NSM_RESPONSE_MAX_SIZE * ctypes.c_uint8)()
+        self.response_view = memoryview(self.response_buffer).cast('B')
+
+    def _store(self, response) -> int:
+        """Encode a response into the response buffer and return its length."""
+        encoded = cbor2.dumps(response)
+        self.response_view[:len(encoded)] = encoded
+        return len(encoded)
+
+    def test_fast_path_matches_fallback(self):
+        # Lengths with the length in the initial byte, and in 1 and 2 extra bytes.
+        for length in [0, 1, 23, 24, 255, 256, 300, 12000]:
+            random_bytes = bytes(range(256)) * (length // 256 + 1)
+            random_bytes = random_bytes[:length]
+            response_length = self._store({'GetRandom': {'random': random_bytes}})
+            with self.subTest(length=length):
+                self.assertIsNotNone(
+                    aws_nsm_interface._locate_random_bytes(self.response_view, response_length)
+                )
+                self.assertEqual(
+                    aws_nsm_interface._decode_get_random_response(
+                        self.response_view,
+                        response_length
+                    ),
+                    random_bytes
+                )
+                self.assertEqual(
+                    aws_nsm_interface._decode_get_random_fallback(
+                        self.response_view,
+                        response_length
+                    ),
+                    random_bytes
+                )
+
+    def test_unexpected_shape_uses_fallback(self):
+        response_length = self._store({'GetRandom': {'random': b'ab', 'extra': 1}})
+        self.assertIsNone(
+            aws_nsm_interface._locate_random_bytes(self.response_view, response_length)
+        )
+        self.assertEqual(
+            aws_nsm_interface._decode_get_random_response(self.response_view, response_length),
+            b'ab'
+        )
+
+    def test_indefinite_length_uses_fallback(self):
+        # A byte string of indefinite length (0x5f) made of two chunks.
+        encoded = b'\xa1iGetRandom\xa1frandom\x5fBabAc\xff'
+        self.response_view[:len(encoded)] = encoded
+        self.assertIsNone(
+            aws_nsm_interface._locate_random_bytes(self.response_view, len(encoded))
+        )
+        self.assertEqual(
+            aws_nsm_interface._decode_get_random_response(self.response_view, len(encoded)),
+            b'abc'
+        )
+
+    def test_error_response(self):
+        response_length = self._store({'Error': 'InternalError'})
+        self.assertIsNone(
+            aws_nsm_interface._locate_random_bytes(self.response_view, response_length)
+        )
+        with self.assertRaisesRegex(aws_nsm_interface.IoctlError, 'InternalError'):
+            aws_nsm_interface._decode_get_random_response(self.response_view, response_length)
+
+if __name__ == '__main__':
+    unittest.main()